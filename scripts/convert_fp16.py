@@ -0,0 +1,19 @@
+import onnx  # type: ignore
+
+from pathlib import Path
+from onnxconverter_common import float16  # type: ignore
+
+MODEL_PATH = Path("./models/seg_model.onnx")
+SAVE_TO = Path("./models/seg_model_fp16.onnx")
+
+
+def main() -> None:
+    model = onnx.load(MODEL_PATH)
+    # inputs and outputs are converted too, so the blob is fp16 end-to-end
+    model = float16.convert_float_to_float16(model, keep_io_types=False)
+    onnx.checker.check_model(model)
+    onnx.save(model, SAVE_TO)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import onnx  # type: ignore
+
+from pathlib import Path
+from onnx import numpy_helper
+
+MODEL_PATH = Path("./models/seg_model.onnx")
+BATCH_DIM = "N"
+
+
+def main() -> None:
+    model = onnx.load(MODEL_PATH)
+    graph = model.graph
+
+    constants = {
+        node.output[0]: node for node in graph.node if node.op_type == "Constant"
+    }
+    for node in graph.node:
+        if node.op_type != "Reshape":
+            continue
+        const = constants[node.input[1]]
+        shape = numpy_helper.to_array(const.attribute[0].t).copy()
+        assert shape[0] == 1, shape
+        # `0` copies the batch dim from the input, `-1` infers it
+        shape[0] = 0 if -1 in shape else -1
+        const.attribute[0].t.CopyFrom(numpy_helper.from_array(shape))
+
+    for tensor in [*graph.input, *graph.output]:
+        dim = tensor.type.tensor_type.shape.dim[0]
+        dim.ClearField("dim_value")
+        dim.dim_param = BATCH_DIM
+    del graph.value_info[:]
+
+    onnx.checker.check_model(model)
+    onnx.save(model, MODEL_PATH)
+
+
+if __name__ == "__main__":
+    main()
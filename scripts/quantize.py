@@ -0,0 +1,15 @@
+from pathlib import Path
+from onnxruntime.quantization import QuantType, quantize_dynamic  # type: ignore
+
+MODEL_PATH = Path("./models/seg_model.onnx")
+SAVE_TO = Path("./models/seg_model_int8.onnx")
+
+
+def main() -> None:
+    # onnxruntime has no CPU ConvInteger kernel for signed weights,
+    # so the weights are quantized to uint8
+    quantize_dynamic(MODEL_PATH, SAVE_TO, weight_type=QuantType.QUInt8)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,15 @@ def sigmoid(x: np.ndarray) -> np.ndarray:
     return 1 / (1 + np.exp(-x))
 
 
+def sigmoid_inplace(x: np.ndarray) -> np.ndarray:
+    # same as sigmoid, but every step reuses the buffer of x
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1
+    np.reciprocal(x, out=x)
+    return x
+
+
 def draw_box(
     image: PILImage,
     box: Box,
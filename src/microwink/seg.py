@@ -1,10 +1,13 @@
 import os
+import functools
 import numpy as np
 import onnxruntime as ort  # type: ignore
 
 from numpy.typing import DTypeLike
 from typing import Any, NewType
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from pathlib import Path
 from PIL import Image
 from PIL.Image import Image as PILImage, Resampling
 
@@ -48,18 +51,66 @@ class SegModel:
     dtype: Dtype
     model_width: int
     model_height: int
+    dynamic_batch: bool
     input_: Any
 
     @staticmethod
     def from_path(
-        path: str | os.PathLike, providers: list[str] | None = None
+        path: str | os.PathLike,
+        providers: list[str] | None = None,
+        prefer_fp16: bool = False,
+        num_threads: int | None = None,
+        optimized_dir: str | os.PathLike | None = None,
+        quantized: bool = False,
     ) -> "SegModel":
-        session = ort.InferenceSession(
-            path,
-            providers=providers or ["CPUExecutionProvider"],
+        assert not (prefer_fp16 and quantized)
+        if prefer_fp16:
+            fp16_path = SegModel.fp16_path(path)
+            if fp16_path.exists():
+                path = fp16_path
+        if quantized:
+            path = SegModel.int8_path(path)
+            assert path.exists(), f"{path} doesn't exist"
+
+        path = Path(path).resolve()
+        if optimized_dir is not None:
+            optimized_dir = str(Path(optimized_dir).resolve())
+        session = load_session(
+            str(path),
+            path.stat().st_mtime_ns,
+            tuple(providers or ["CPUExecutionProvider"]),
+            num_threads=num_threads,
+            optimized_dir=optimized_dir,
         )
         return SegModel.from_session(session)
 
+    @staticmethod
+    def session_options(num_threads: int | None = None) -> ort.SessionOptions:
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if num_threads is not None:
+            assert num_threads > 0
+            options.intra_op_num_threads = num_threads
+        return options
+
+    @staticmethod
+    def fp16_path(path: str | os.PathLike) -> Path:
+        path = Path(path)
+        return path.with_name(f"{path.stem}_fp16{path.suffix}")
+
+    @staticmethod
+    def int8_path(path: str | os.PathLike) -> Path:
+        path = Path(path)
+        return path.with_name(f"{path.stem}_int8{path.suffix}")
+
+    @staticmethod
+    def optimized_path(
+        path: str | os.PathLike, optimized_dir: str | os.PathLike
+    ) -> Path:
+        path = Path(path)
+        return Path(optimized_dir) / f"{path.stem}.optimized{path.suffix}"
+
     @staticmethod
     def from_session(session: ort.InferenceSession) -> "SegModel":
         return SegModel(session)
@@ -69,27 +120,53 @@ class SegModel:
         inputs = self.session.get_inputs()
         assert len(inputs) == 1, len(inputs)
         self.input_ = inputs[0]
+        # dynamically quantized models keep a float input
         if self.input_.type == "tensor(float16)":
             self.dtype = np.float16
-        else:
+        elif self.input_.type == "tensor(float)":
             self.dtype = np.float32
+        else:
+            raise ValueError(f"unsupported input type: {self.input_.type}")
         B, _, H, W = self.input_.shape
-        assert B == 1, "batching is not supported"
+        self.dynamic_batch = isinstance(B, str)
+        assert self.dynamic_batch or B == 1, f"unsupported batch size: {B}"
         self.model_height = H
         self.model_width = W
 
     def apply(
         self, image: PILImage, threshold: Threshold = Threshold()
     ) -> list[SegResult]:
-        CLASS_ID = 0
-        assert image.mode == "RGB"
-        assert image.width > 0
-        assert image.height > 0
+        return self.apply_batch([image], threshold)[0]
+
+    def apply_batch(
+        self,
+        images: list[PILImage],
+        threshold: Threshold = Threshold(),
+        max_batch_size: int = 8,
+    ) -> list[list[SegResult]]:
+        # every image in a model run costs ~40 MB of activations,
+        # so long lists are split into runs of at most max_batch_size
+        assert max_batch_size > 0
+        for image in images:
+            assert image.mode == "RGB"
+            assert image.width > 0
+            assert image.height > 0
 
         assert 0.0 <= threshold.iou <= 1.0
         assert 0.0 <= threshold.confidence <= 1.0
 
-        raw = self._run(image, threshold.confidence, iou_threshold=threshold.iou)
+        raws = self._run_batch(
+            images,
+            threshold.confidence,
+            iou_threshold=threshold.iou,
+            max_batch_size=max_batch_size,
+        )
+        assert len(raws) == len(images)
+        return [self._to_results(raw) for raw in raws]
+
+    @staticmethod
+    def _to_results(raw: RawResult | None) -> list[SegResult]:
+        CLASS_ID = 0
         if raw is None:
             return []
 
@@ -108,33 +185,69 @@ class SegModel:
             )
         return results
 
-    def _run(
-        self, image: PILImage, conf_threshold: float, iou_threshold: float
-    ) -> RawResult | None:
+    def _run_batch(
+        self,
+        images: list[PILImage],
+        conf_threshold: float,
+        iou_threshold: float,
+        max_batch_size: int,
+    ) -> list[RawResult | None]:
         NM = 32
-        assert image.mode == "RGB"
-        blob, ratio, (pad_w, pad_h) = self.preprocess(image)
-        assert blob.ndim == 4
-        preds = self.session.run(None, {self.input_.name: blob})
-        return self.postprocess(
-            preds,
-            img_size=(H(image.height), W(image.width)),
-            ratio=ratio,
-            pad_w=pad_w,
-            pad_h=pad_h,
-            conf_threshold=conf_threshold,
-            iou_threshold=iou_threshold,
-            nm=NM,
-        )
+        chunk_size = max_batch_size if self.dynamic_batch else 1
+
+        results = []
+        for start in range(0, len(images), chunk_size):
+            chunk = images[start : start + chunk_size]
+            blob, ratios, pads = self.preprocess_batch(chunk)
+            assert blob.ndim == 4
+            preds = self.session.run(None, {self.input_.name: blob})
+            assert all(len(pred) == len(chunk) for pred in preds)
+
+            for i, image in enumerate(chunk):
+                pad_w, pad_h = pads[i]
+                raw = self.postprocess(
+                    [pred[i : i + 1] for pred in preds],
+                    img_size=(H(image.height), W(image.width)),
+                    ratio=ratios[i],
+                    pad_w=pad_w,
+                    pad_h=pad_h,
+                    conf_threshold=conf_threshold,
+                    iou_threshold=iou_threshold,
+                    nm=NM,
+                )
+                results.append(raw)
+        return results
+
+    def preprocess_batch(
+        self, images: list[PILImage]
+    ) -> tuple[np.ndarray, list[float], list[tuple[float, float]]]:
+        N = len(images)
+        assert N > 0
+        batch = np.empty((N, 3, self.model_height, self.model_width), dtype=self.dtype)
+
+        def work(i: int) -> tuple[float, tuple[float, float]]:
+            _, ratio, pad = self.preprocess(images[i], out=batch[i : i + 1])
+            return ratio, pad
+
+        # PIL resampling and NumPy ufuncs release the GIL, so threads scale
+        num_workers = min(N, os.cpu_count() or 1)
+        if num_workers == 1:
+            results = [work(i) for i in range(N)]
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                results = list(executor.map(work, range(N)))
+        ratios = [ratio for ratio, _ in results]
+        pads = [pad for _, pad in results]
+        return batch, ratios, pads
 
     def preprocess(
-        self, image: PILImage
+        self, image: PILImage, out: np.ndarray | None = None
     ) -> tuple[np.ndarray, float, tuple[float, float]]:
         BORDER_COLOR = (114, 114, 114)
         EPS = 0.1
 
         assert image.mode == "RGB"
-        img = np.array(image)
+        img = np.asarray(image)
 
         ih, iw, _ = img.shape
         oh, ow = self.model_height, self.model_width
@@ -149,16 +262,13 @@ class SegModel:
         ]
         if (iw, ih) != (rw, rh):
             img = resize(img, (W(rw), H(rh)))
-        top, bottom = round(pad_h - EPS), round(pad_h + EPS)
-        left, right = round(pad_w - EPS), round(pad_w + EPS)
-        img = self.with_border(img, top, bottom, left, right, BORDER_COLOR)
-        assert img.ndim == 3
-        blob = (1 / 255.0) * np.ascontiguousarray(
-            np.einsum("HWC->CHW", img),  # type: ignore
-            dtype=self.dtype,
-        )
-        assert blob.ndim == 3
-        blob = blob[None]
+        top = round(pad_h - EPS)
+        left = round(pad_w - EPS)
+        assert img.shape == (rh, rw, 3)
+        blob = np.empty((1, 3, oh, ow), dtype=self.dtype) if out is None else out
+        assert blob.shape == (1, 3, oh, ow)
+        assert blob.dtype == self.dtype
+        self.letterbox(img, blob[0], top, left, BORDER_COLOR)
         return blob, r, (pad_w, pad_h)
 
     def postprocess(
@@ -179,15 +289,20 @@ class SegModel:
         x, protos = preds
         assert len(x) == len(protos) == B
         protos = protos[0]
-        x = x[0].T
+        x = x[0]
         assert protos.shape == (NM, MH, MW), protos.shape
-        assert x.shape == (len(x), 4 + NUM_CLASSES + NM)
+        assert x.shape == (4 + NUM_CLASSES + NM, x.shape[1])
 
-        likely = x[:, 4 : 4 + NUM_CLASSES].max(axis=1) > conf_threshold
+        # filter anchors on the contiguous score rows, then gather only the
+        # few that survive
+        scores = x[4 : 4 + NUM_CLASSES].max(axis=0)
+        likely = scores > conf_threshold
         assert likely.ndim == 1
-        x = x[likely]
+        # fp16 outputs are upcast only after filtering, so box math stays precise
+        scores = scores[likely].astype(np.float32, copy=False)
+        x = x[:, likely].astype(np.float32, copy=False).T
+        class_ids = x[:, 4 : 4 + NUM_CLASSES].argmax(axis=1)
 
-        scores = x[:, 4 : 4 + NUM_CLASSES].max(axis=1)
         boxes = x[:, :4]
         boxes = self.postprocess_boxes(boxes, img_size, ratio, pad_w=pad_w, pad_h=pad_h)
         keep = self.nms(
@@ -198,7 +313,6 @@ class SegModel:
         N = len(keep)
         if N == 0:
             return None
-        class_ids = x[:, 4 : 4 + NUM_CLASSES].argmax(axis=1)
         masks_in = x[:, 4 + NUM_CLASSES :]
 
         scores = scores[keep]
@@ -229,15 +343,18 @@ class SegModel:
         pad_h: float,
     ) -> np.ndarray:
         boxes = boxes.copy()
-        boxes[:, [0, 1]] -= boxes[:, [2, 3]] / 2
-        boxes[:, [2, 3]] += boxes[:, [0, 1]]
+        # cxcywh -> xyxy in place, through views instead of fancy indexing
+        xy, wh = boxes[:, :2], boxes[:, 2:]
+        xy -= wh / 2
+        wh += xy
 
-        boxes -= [pad_w, pad_h, pad_w, pad_h]
+        boxes -= np.array([pad_w, pad_h, pad_w, pad_h], dtype=boxes.dtype)
         boxes /= ratio
 
         ih, iw = img_size
-        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, iw)
-        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, ih)
+        xs, ys = boxes[:, 0::2], boxes[:, 1::2]
+        np.clip(xs, 0, iw, out=xs)
+        np.clip(ys, 0, ih, out=ys)
         return boxes
 
     def postprocess_masks(
@@ -248,21 +365,41 @@ class SegModel:
         img_size: tuple[H, W],
     ) -> np.ndarray:
         N = len(masks_in)
-        nm, mh, mw = protos.shape
+        nm, _, _ = protos.shape
         assert boxes.shape == (N, 4)
         assert masks_in.shape == (N, nm)
+        # rows are fed to BLAS one by one, strided rows would take a slow path
+        masks_in = np.ascontiguousarray(masks_in)
 
-        masks = np.matmul(masks_in, protos.reshape((nm, -1))).reshape((N, mh, mw))
         ih, iw = img_size
-        masks = self._scale_masks(np.ascontiguousarray(masks), (ih, iw))
-        assert masks.shape == (N, ih, iw)
-        return common.sigmoid(self._crop_masks(masks, boxes))
+        protos = self._unpad_protos(protos, (ih, iw))
+        _, ph, pw = protos.shape
+        ry = bilinear_weights(ph, ih, dtype=masks_in.dtype)
+        rx = bilinear_weights(pw, iw, dtype=masks_in.dtype)
+
+        # only the part of each mask inside its box is computed and upscaled,
+        # everything outside stays zero
+        masks = np.zeros((N, ih, iw), dtype=masks_in.dtype)
+        bounds = self._box_bounds(boxes)
+        for i, (x1, y1, x2, y2) in enumerate(bounds):
+            if x1 >= x2 or y1 >= y2:
+                continue
+            wy, (py1, py2) = self._weights_support(ry[y1:y2])
+            wx, (px1, px2) = self._weights_support(rx[x1:x2])
+            # fp16 protos are upcast per window, NumPy has no fp16 BLAS
+            proto = protos[:, py1:py2, px1:px2].reshape((nm, -1))
+            proto = proto.astype(masks_in.dtype, copy=False)
+            mask = np.matmul(masks_in[i], proto).reshape((py2 - py1, px2 - px1))
+            region = masks[i, y1:y2, x1:x2]
+            np.matmul(np.matmul(wy, mask), wx.T, out=region)
+            common.sigmoid_inplace(region)
+        return masks
 
     @staticmethod
-    def _scale_masks(masks: np.ndarray, img_size: tuple[H, W]) -> np.ndarray:
+    def _unpad_protos(protos: np.ndarray, img_size: tuple[H, W]) -> np.ndarray:
         EPS = 0.1
         ih, iw = img_size
-        N, mh, mw = masks.shape
+        _, mh, mw = protos.shape
 
         gain = min(mh / ih, mw / iw)
         pad_w = (mw - iw * gain) / 2
@@ -274,26 +411,28 @@ class SegModel:
         left = round(pad_w - EPS)
         right = round(mw - pad_w + EPS)
 
-        masks = masks[:, top:bottom, left:right]
-        masks_out = np.zeros((N, ih, iw))
-        for i, mask in enumerate(masks):
-            resized_mask = resize(mask, (iw, ih))
-            assert resized_mask.shape == (ih, iw)
-            masks_out[i] = resized_mask
-        return masks_out
+        # very thin images would leave no proto rows (or cols) at all
+        bottom = max(bottom, top + 1)
+        right = max(right, left + 1)
+        return protos[:, top:bottom, left:right]
 
     @staticmethod
-    def _crop_masks(masks: np.ndarray, boxes: np.ndarray) -> np.ndarray:
-        N, mh, mw = masks.shape
+    def _box_bounds(boxes: np.ndarray) -> np.ndarray:
+        # integer pixel bounds [x1, x2) x [y1, y2) of the pixels inside each box
+        N = len(boxes)
         assert boxes.shape == (N, 4)
-        x1, y1, x2, y2 = np.split(boxes[:, :, None], 4, 1)
-        r = np.arange(mw, dtype=x1.dtype)[None, None, :]
-        c = np.arange(mh, dtype=x1.dtype)[None, :, None]
-        assert r.shape == (1, 1, mw)
-        assert c.shape == (1, mh, 1)
-        masks_out = masks * ((r >= x1) * (r < x2) * (c >= y1) * (c < y2))
-        assert masks_out.shape == (N, mh, mw)
-        return masks_out
+        bounds = np.ceil(boxes).astype(np.int64)
+        assert bounds.shape == (N, 4)
+        return bounds
+
+    @staticmethod
+    def _weights_support(
+        weights: np.ndarray,
+    ) -> tuple[np.ndarray, tuple[int, int]]:
+        # narrows interpolation weights to the source range they actually use
+        (used,) = np.nonzero(weights.any(axis=0))
+        start, end = int(used[0]), int(used[-1]) + 1
+        return weights[:, start:end], (start, end)
 
     @staticmethod
     def nms(
@@ -308,10 +447,14 @@ class SegModel:
         assert scores.shape == (N,)
         assert sorted_indices.shape == (N,)
 
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
         keep_boxes = []
         while sorted_indices.size > 0:
             box_id = int(sorted_indices[0])
-            ious = SegModel._compute_iou(boxes[box_id, :], boxes[sorted_indices[1:], :])
+            rest = sorted_indices[1:]
+            ious = SegModel._compute_iou(
+                boxes[box_id, :], boxes[rest, :], areas[box_id], areas[rest]
+            )
             keep_indices = np.where(ious < iou_threshold)[0]
             sorted_indices = sorted_indices[keep_indices + 1]
 
@@ -319,47 +462,123 @@ class SegModel:
         return keep_boxes
 
     @staticmethod
-    def _compute_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    def _compute_iou(
+        box: np.ndarray,
+        boxes: np.ndarray,
+        box_area: np.ndarray,
+        boxes_area: np.ndarray,
+    ) -> np.ndarray:
         assert box.shape == (4,)
         assert boxes.shape == (len(boxes), 4)
+        assert boxes_area.shape == (len(boxes),)
         xmin = np.maximum(box[0], boxes[:, 0])
         ymin = np.maximum(box[1], boxes[:, 1])
         xmax = np.minimum(box[2], boxes[:, 2])
         ymax = np.minimum(box[3], boxes[:, 3])
 
         intersection_area = np.maximum(0, xmax - xmin) * np.maximum(0, ymax - ymin)
-
-        box_area = (box[2] - box[0]) * (box[3] - box[1])
-        boxes_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
         union_area = box_area + boxes_area - intersection_area
 
         iou = intersection_area / union_area
         return iou
 
     @staticmethod
-    def with_border(
+    def letterbox(
         img: np.ndarray,
+        out: np.ndarray,
         top: int,
-        bottom: int,
         left: int,
-        right: int,
         color: Color,
     ) -> np.ndarray:
+        # writes the HWC img into the CHW out at (top, left), scaled to [0, 1],
+        # the borders around it are filled with color
+        SCALE = np.float32(1 / 255.0)
         assert img.ndim == 3
-        pil_img = Image.fromarray(img)
-        ow = pil_img.width + left + right
-        oh = pil_img.height + top + bottom
-        out = Image.new("RGB", (ow, oh), color)
-        out.paste(pil_img, (left, top))
-        return np.array(out).astype(img.dtype)
+        ih, iw, ch = img.shape
+        _, oh, ow = out.shape
+        assert out.shape[0] == ch == len(color)
+        bottom, right = oh - top - ih, ow - left - iw
+        assert min(top, bottom, left, right) >= 0
+
+        fill = (np.array(color, dtype=np.float32) * SCALE)[:, None, None]
+        out[:, :top] = fill
+        out[:, top + ih :] = fill
+        out[:, top : top + ih, :left] = fill
+        out[:, top : top + ih, left + iw :] = fill
+        # HWC->CHW, cast and scale in a single pass
+        np.multiply(
+            img.transpose(2, 0, 1),
+            SCALE,
+            out=out[:, top : top + ih, left : left + iw],
+            casting="unsafe",
+        )
+        return out
+
+
+# Sessions are safe to share between models and threads, and building one
+# runs the whole graph optimization, so repeated loads reuse them.
+# The cache has room for every shipped model variant with a few option sets.
+# Each cached session keeps its weights and memory arena alive; call
+# `load_session.cache_clear()` to release them. `mtime_ns` is only part of the
+# key, so a model re-exported in place gets a fresh session.
+@functools.lru_cache(maxsize=8)
+def load_session(
+    path: str,
+    mtime_ns: int,
+    providers: tuple[str, ...],
+    num_threads: int | None = None,
+    optimized_dir: str | None = None,
+) -> ort.InferenceSession:
+    options = SegModel.session_options(num_threads)
+    if optimized_dir is not None:
+        # the optimized graph is hardware specific, so optimized_dir should be
+        # per machine. It is named after the source model and rebuilt whenever
+        # the source is newer, so it can't stand in for another graph.
+        source = Path(path)
+        optimized = SegModel.optimized_path(source, optimized_dir)
+        if optimized.exists() and optimized.stat().st_mtime >= source.stat().st_mtime:
+            path = str(optimized)
+            level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            options.graph_optimization_level = level
+        else:
+            optimized.parent.mkdir(parents=True, exist_ok=True)
+            options.optimized_model_filepath = str(optimized)
+
+    return ort.InferenceSession(
+        path,
+        sess_options=options,
+        providers=list(providers),
+    )
 
 
 def resize(buf: np.ndarray, size: tuple[W, H]) -> np.ndarray:
     w, h = size
     assert w > 0
     assert h > 0
-    img = Image.fromarray(buf).resize(size, Resampling.LANCZOS)
-    out = np.array(img).astype(buf.dtype)
+    # PIL widens the bilinear support when downscaling, so this also antialiases
+    img = Image.fromarray(buf).resize(size, Resampling.BILINEAR)
+    out = np.asarray(img)
     assert out.dtype == buf.dtype
     assert out.ndim == buf.ndim
     return out
+
+
+@functools.lru_cache(maxsize=32)
+def bilinear_weights(src: int, dst: int, dtype: Dtype = np.float32) -> np.ndarray:
+    # (dst, src) matrix with the same weights as PIL's bilinear filter,
+    # cached since image sizes tend to repeat, hence read-only
+    assert src > 0
+    assert dst > 0
+    scale = src / dst
+    support = max(scale, 1.0)
+    centers = (np.arange(dst) + 0.5) * scale
+    pixels = np.arange(src) + 0.5
+    weights = np.subtract.outer(centers, pixels)
+    np.abs(weights, out=weights)
+    weights *= -1.0 / support
+    weights += 1.0
+    np.maximum(weights, 0.0, out=weights)
+    weights /= weights.sum(axis=1, keepdims=True)
+    out = weights.astype(dtype)
+    out.flags.writeable = False
+    return out
@@ -9,3 +9,17 @@ def seg_model() -> SegModel:
     path = Path("./models/seg_model.onnx")
     assert path.exists()
     return SegModel.from_path(path)
+
+
+@pytest.fixture(scope="package")
+def seg_model_fp16() -> SegModel:
+    path = Path("./models/seg_model.onnx")
+    assert SegModel.fp16_path(path).exists()
+    return SegModel.from_path(path, prefer_fp16=True)
+
+
+@pytest.fixture(scope="package")
+def seg_model_int8() -> SegModel:
+    path = Path("./models/seg_model.onnx")
+    assert SegModel.int8_path(path).exists()
+    return SegModel.from_path(path, quantized=True)
@@ -1,9 +1,15 @@
+import pytest
+import numpy as np
+
 from microwink import SegModel, Threshold
+from microwink.common import sigmoid, sigmoid_inplace
 from hypothesis import (
     given,
     settings,
     strategies as st,
 )
+from hypothesis.extra import numpy as npst
+from PIL import Image
 from PIL.Image import Image as PILImage
 
 from .utils.proptest import arbitrary_rgb_image as arb_img
@@ -21,6 +27,8 @@ def test_preprocess(img: PILImage, seg_model: SegModel) -> None:
 
     blob, *_ = seg_model.preprocess(img)
     assert blob.shape == (B, CH, H, W)
+    assert blob.dtype == seg_model.dtype
+    assert blob.flags.c_contiguous
     assert blob.min() >= 0.0
     assert blob.max() <= 1.0
 
@@ -50,3 +58,28 @@ def test_apply(
         assert obj.score >= threshold.confidence
         assert obj.mask.min() >= 0.0
         assert obj.mask.max() <= 1.0
+
+
+@given(
+    x=npst.arrays(
+        dtype=st.sampled_from([np.float16, np.float32, np.float64]),
+        shape=npst.array_shapes(max_dims=3),
+        elements=st.floats(-10, 10, width=16),
+    )
+)
+def test_sigmoid_inplace(x: np.ndarray) -> None:
+    expected = sigmoid(x)
+    out = sigmoid_inplace(x)
+    assert out is x
+    assert out.dtype == expected.dtype
+    assert np.array_equal(out, expected)
+
+
+@pytest.mark.parametrize(["size"], [((3000, 1),), ((1, 3000),), ((2000, 1),)])
+def test_apply_thin(size: tuple[int, int], seg_model: SegModel) -> None:
+    img = Image.new("RGB", size)
+    objects = seg_model.apply(img, threshold=Threshold(confidence=0.0))
+    for obj in objects:
+        assert obj.mask.shape == (img.height, img.width)
+        assert obj.mask.min() >= 0.0
+        assert obj.mask.max() <= 1.0
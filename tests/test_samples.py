@@ -1,4 +1,8 @@
+import math
+import os
+import shutil
 import pytest
+import numpy as np
 
 from pathlib import Path
 from PIL import Image
@@ -22,14 +26,14 @@ BIN_THRESHOLD = 0.5
         ("mklovin.png", [Box(x=84, y=194, h=448, w=715)]),
         (
             "two_ids.png",
-            [Box(x=159, y=33, h=246, w=400), Box(x=653, y=32, h=240, w=384)],
+            [Box(x=159, y=33, h=246, w=400), Box(x=653, y=32, h=241, w=384)],
         ),
         (
             "three_ids.png",
             [
-                Box(x=62, y=97, h=245, w=391),
+                Box(x=62, y=98, h=245, w=391),
                 Box(x=751, y=92, h=245, w=393),
-                Box(x=479, y=23, h=390, w=246),
+                Box(x=479, y=23, h=390, w=247),
             ],
         ),
     ],
@@ -52,7 +56,131 @@ def test_samples(
         assert card.mask.min() >= 0.0
         assert card.mask.max() <= 1.0
         assert round_box(card.box) == box
+        assert_zero_outside(card.mask, card.box)
 
         actual = draw_box(actual, card.box)
         actual = draw_mask(actual, card.mask > BIN_THRESHOLD)
     assert truth == actual
+
+
+def assert_zero_outside(mask: np.ndarray, box: Box) -> None:
+    x1, y1 = math.ceil(box.x), math.ceil(box.y)
+    x2, y2 = math.ceil(box.x + box.w), math.ceil(box.y + box.h)
+    outside = mask.copy()
+    outside[y1:y2, x1:x2] = 0.0
+    assert not outside.any()
+
+
+def test_apply_batch(seg_model: SegModel) -> None:
+    filenames = [
+        "us_card.png",
+        "us_card_rotated.png",
+        "mklovin.png",
+        "two_ids.png",
+        "three_ids.png",
+    ]
+    imgs = [Image.open(DATA_ROOT / name).convert("RGB") for name in filenames]
+
+    expected = [seg_model.apply(img) for img in imgs]
+    for max_batch_size in [1, 2, 8]:
+        batch = seg_model.apply_batch(imgs, max_batch_size=max_batch_size)
+        assert len(batch) == len(imgs)
+        for cards, truths in zip(batch, expected):
+            assert len(cards) == len(truths)
+            for card, truth in zip(cards, truths):
+                assert card.score == pytest.approx(truth.score, abs=1e-4)
+                assert round_box(card.box) == round_box(truth.box)
+                assert np.allclose(card.mask, truth.mask, atol=1e-4)
+    assert seg_model.apply_batch([]) == []
+
+
+def test_preprocess_batch_threads(
+    seg_model: SegModel, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    filenames = ["us_card.png", "us_card_rotated.png", "mklovin.png", "two_ids.png"]
+    imgs = [Image.open(DATA_ROOT / name).convert("RGB") for name in filenames]
+
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    batch, ratios, pads = seg_model.preprocess_batch(imgs)
+    assert batch.shape[0] == len(imgs)
+    for i, img in enumerate(imgs):
+        blob, ratio, pad = seg_model.preprocess(img)
+        assert np.array_equal(batch[i : i + 1], blob)
+        assert ratios[i] == ratio
+        assert pads[i] == pad
+
+
+def test_fp16(seg_model: SegModel, seg_model_fp16: SegModel) -> None:
+    assert seg_model_fp16.dtype == np.float16
+    assert_close_results(
+        seg_model_fp16, seg_model, box_tolerance=1.0, score_tolerance=1e-2
+    )
+
+
+def test_int8(seg_model: SegModel, seg_model_int8: SegModel) -> None:
+    assert seg_model_int8.dtype == np.float32
+    assert_close_results(
+        seg_model_int8, seg_model, box_tolerance=8.0, score_tolerance=5e-2
+    )
+
+
+def assert_close_results(
+    model: SegModel,
+    reference: SegModel,
+    box_tolerance: float,
+    score_tolerance: float,
+) -> None:
+    for path in sorted(DATA_ROOT.iterdir()):
+        img = Image.open(path).convert("RGB")
+        expected = sorted(reference.apply(img), key=lambda card: card.box.x)
+        cards = sorted(model.apply(img), key=lambda card: card.box.x)
+        assert len(cards) == len(expected)
+        for card, truth in zip(cards, expected):
+            assert card.score == pytest.approx(truth.score, abs=score_tolerance)
+            assert card.box.x == pytest.approx(truth.box.x, abs=box_tolerance)
+            assert card.box.y == pytest.approx(truth.box.y, abs=box_tolerance)
+            assert card.box.w == pytest.approx(truth.box.w, abs=box_tolerance)
+            assert card.box.h == pytest.approx(truth.box.h, abs=box_tolerance)
+            assert card.mask.dtype == np.float32
+            assert card.mask.min() >= 0.0
+            assert card.mask.max() <= 1.0
+
+
+def test_optimized_dir(tmp_path: Path) -> None:
+    model_path = Path("./models/seg_model.onnx")
+    img = Image.open(DATA_ROOT / "two_ids.png").convert("RGB")
+
+    cold = SegModel.from_path(model_path, optimized_dir=tmp_path, num_threads=1)
+    optimized_path = SegModel.optimized_path(model_path, tmp_path)
+    assert optimized_path.exists()
+    warm = SegModel.from_path(model_path, optimized_dir=tmp_path)
+
+    expected = cold.apply(img)
+    cards = warm.apply(img)
+    assert len(cards) == len(expected)
+    for card, truth in zip(cards, expected):
+        assert card.score == pytest.approx(truth.score, abs=1e-4)
+        assert round_box(card.box) == round_box(truth.box)
+
+    # other variants get their own optimized graph instead of reusing this one
+    fp16 = SegModel.from_path(model_path, prefer_fp16=True, optimized_dir=tmp_path)
+    assert fp16.dtype == np.float16
+    assert SegModel.optimized_path(SegModel.fp16_path(model_path), tmp_path).exists()
+
+
+def test_session_cache(seg_model: SegModel) -> None:
+    path = Path("./models/seg_model.onnx")
+    assert SegModel.from_path(path).session is seg_model.session
+    assert SegModel.from_path(path.resolve()).session is seg_model.session
+    assert SegModel.from_path(path, num_threads=1).session is not seg_model.session
+
+
+def test_session_cache_reexport(tmp_path: Path) -> None:
+    path = tmp_path / "seg_model.onnx"
+    shutil.copy("./models/seg_model.onnx", path)
+    session = SegModel.from_path(path).session
+    assert SegModel.from_path(path).session is session
+
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert SegModel.from_path(path).session is not session